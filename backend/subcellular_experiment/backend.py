@@ -1,33 +1,45 @@
 import os
-import json
 import asyncio
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from types import FrameType
-from typing import Union, Any, Optional
+from typing import Union, Any, Optional, Dict, List, Callable, Awaitable, ClassVar
 import signal
 from uuid import uuid4
 
+import msgspec
+import orjson
 import tornado.ioloop
 import tornado.websocket
 from tornado.web import RequestHandler, Application, StaticFileHandler
 import sentry_sdk
 from sentry_sdk.integrations.tornado import TornadoIntegration
 
-from .utils import ExtendedJSONEncoder, umask
+try:
+    import uvloop
+except ImportError:
+    uvloop = None  # type: ignore
+
+from .utils import create_background_task, encode_json, encode_message, encode_raw_message, umask
+from .cache import QueryCache
 from .sim_manager import SimManager, SimWorker
 from .db import Db
 from .geometry import create_geometry
 from .model_export import get_exported_model
-from .model_import import revision_from_excel
+from .model_import import REVISION_STRUCTURE, revision_from_excel
 from .viz import contact_map, reactivity_network
 from .sbml_to_bngl import sbml_to_bngl
 from .logger import get_logger
 from .envvars import SENTRY_DSN
 from .api import fetch_model
 
-from .worker_message import SimWorkerMessage
+from .worker_message import SIM_WORKER_MESSAGE_DECODER
 from .types import (
     SimConfig,
     Message,
+    MESSAGE_DECODER,
     SimId,
     WebSocketHandler,
     Simulation,
@@ -48,9 +60,56 @@ if SENTRY_DSN is not None:
 
 L = get_logger(__name__)
 
+# Has to be installed before the first event loop is created by the db client or tornado
+if uvloop is not None:
+    uvloop.install()
+else:
+    L.info("uvloop is not available, using the default asyncio event loop")
+
+# Runners already persist traces in chunks of about a megabyte, small traces are grouped
+# into one frame while large ones are sent one document per frame.
+TRACE_BATCH_MAX_BYTES = 4 * 1024 * 1024
+
 db = Db()
 sim_manager = SimManager(db)
 
+# Model conversions are CPU bound pure python, run them out of the IOLoop process.
+# Spawned workers re-run main.py as __mp_main__, which imports the whole sim worker (STEPS, pysb,
+# sentry init), and python 3.8 starts all of them on the first submit, so keep the pool small.
+CPU_POOL_WORKERS = 2
+
+
+def create_cpu_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=CPU_POOL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+cpu_pool = create_cpu_pool()
+
+
+async def run_in_cpu_pool(fn: Callable, *args: Any) -> Any:
+    global cpu_pool  # pylint: disable=global-statement
+
+    pool = cpu_pool
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        # A crashed worker (e.g. in libsbml) breaks the pool for good, replace it for the next calls
+        if pool is cpu_pool:
+            L.warning("cpu pool is broken, recreating it")
+            cpu_pool = create_cpu_pool()
+            pool.shutdown(wait=False)
+        raise
+
+
+# Export is deterministic, entries are keyed on the digest of the whole model so they never go stale
+# and are only ever evicted. Exported models are strings, the cache is bounded by their total length.
+EXPORTED_MODEL_CACHE_CHARS = 64 * 1024 * 1024
+exported_model_cache = QueryCache(maxsize=EXPORTED_MODEL_CACHE_CHARS, ttl=None, getsizeof=len)
+
+
+def model_digest(model_dict: dict) -> bytes:
+    return hashlib.blake2b(orjson.dumps(model_dict, option=orjson.OPT_SORT_KEYS), digest_size=16).digest()
+
 
 class WSHandler(WebSocketHandler):
     closed = False
@@ -77,163 +136,218 @@ class WSHandler(WebSocketHandler):
 
     # pylint: disable=invalid-overridden-method
     async def on_message(self, raw_msg: Union[str, bytes]) -> None:
-        msg = Message(**json.loads(raw_msg))
-        L.debug(f"got {msg.cmd} message")
+        msg = MESSAGE_DECODER.decode(raw_msg)
+        L.debug("got %s message", msg.cmd)
 
-        if msg.cmd == "run_simulation":
-            sim_conf = SimConfig(**msg.data)
-            await sim_manager.schedule_sim(sim_conf)
+        handler = WSHandler.HANDLERS.get(msg.cmd)
+        if handler is None:
+            L.warning("unknown command %s", msg.cmd)
+            return
 
-        if msg.cmd == "get_log":
-            sim_id = msg.data
+        await handler(self, msg)
 
-            self.validate_id(sim_id)
+    async def _handle_run_simulation(self, msg: Message) -> None:
+        sim_conf = SimConfig(**msg.data)
+        await sim_manager.schedule_sim(sim_conf)
 
-            if sim_id in sim_manager.running_sim_ids:
-                await sim_manager.request_tmp_sim_log(sim_id, msg.cmdid)
-            else:
-                sim_log = await db.get_sim_log(sim_id)
-                await self.send_message("log", sim_log, cmdid=msg.cmdid)
+    async def _handle_get_log(self, msg: Message) -> None:
+        sim_id = msg.data
 
-        if msg.cmd == "get_trace":
-            sim_id = msg.data
-            self.validate_id(sim_id)
+        self.validate_id(sim_id)
 
-            if sim_id in sim_manager.running_sim_ids:
-                await sim_manager.request_tmp_sim_trace(sim_id, msg.cmdid)
-            else:
-                traces = db.db.simTraces.find({"simId": sim_id})
-                async for trace in traces:
-                    await self.send_message("simTrace", trace)
+        if sim_id in sim_manager.running_sim_ids:
+            await sim_manager.request_tmp_sim_log(sim_id, msg.cmdid)
+        else:
+            sim_log = await db.get_sim_log(sim_id)
+            await self.send_message("log", sim_log, cmdid=msg.cmdid)
 
-        if msg.cmd == "cancel_simulation":
-            await sim_manager.cancel_sim(SimId(**msg.data))
+    async def _handle_get_trace(self, msg: Message) -> None:
+        sim_id = msg.data
+        self.validate_id(sim_id)
 
-        if msg.cmd == "create_simulation":
-            await db.create_simulation(Simulation(**msg.data))
+        if sim_id in sim_manager.running_sim_ids:
+            await sim_manager.request_tmp_sim_trace(sim_id, msg.cmdid)
+        else:
+            trace_batch: List[bytes] = []
+            trace_batch_size = 0
+            async for trace in db.db.simTraces.find({"simId": sim_id}):
+                encoded_trace = encode_json(trace)
+                if trace_batch and trace_batch_size + len(encoded_trace) > TRACE_BATCH_MAX_BYTES:
+                    await self.send_trace_batch(trace_batch)
+                    trace_batch = []
+                    trace_batch_size = 0
 
-        if msg.cmd == "update_simulation":
-            await db.update_simulation(UpdateSimulation(**msg.data))
+                trace_batch.append(encoded_trace)
+                trace_batch_size += len(encoded_trace)
 
-        if msg.cmd == "delete_simulation":
-            sim = SimId(**msg.data)
+            if trace_batch:
+                await self.send_trace_batch(trace_batch)
 
-            await sim_manager.cancel_sim(sim)
-            await db.delete_simulation(sim)
-            await db.delete_sim_spatial_traces(sim)
-            await db.delete_sim_trace(sim)
-            await db.delete_sim_log(sim)
+    async def _handle_cancel_simulation(self, msg: Message) -> None:
+        await sim_manager.cancel_sim(msgspec.convert(msg.data, SimId))
 
-            for path in [
-                f"/data/spatial-traces/{sim.id}.json",
-                f"/data/straces/{sim.id}.json",
-            ]:
-                if os.path.exists(path):
-                    os.remove(path)
+    async def _handle_create_simulation(self, msg: Message) -> None:
+        await db.create_simulation(Simulation(**msg.data))
 
-        if msg.cmd == "get_simulations":
-            model_id = GetSimulations(**msg.data).modelId
+    async def _handle_update_simulation(self, msg: Message) -> None:
+        await db.update_simulation(UpdateSimulation(**msg.data))
 
-            simulations = await db.get_simulations(self.user_id, model_id)
+    async def _handle_delete_simulation(self, msg: Message) -> None:
+        sim = msgspec.convert(msg.data, SimId)
 
-            await self.send_message("simulations", {"simulations": simulations}, cmdid=msg.cmdid)
+        await sim_manager.cancel_sim(sim)
+        await db.delete_simulation(sim)
+        await db.delete_sim_spatial_traces(sim)
+        await db.delete_sim_trace(sim)
+        await db.delete_sim_log(sim)
 
-        if msg.cmd == "create_geometry":
-            geometry_config = msg.data
+        for path in [
+            f"/data/spatial-traces/{sim.id}.json",
+            f"/data/straces/{sim.id}.json",
+        ]:
+            if os.path.exists(path):
+                os.remove(path)
 
-            id_ = str(uuid4())
-            structure_sizes = create_geometry(id_, geometry_config)
+    async def _handle_get_simulations(self, msg: Message) -> None:
+        model_id = GetSimulations(**msg.data).modelId
 
-            await self.send_message(
-                "geometry",
-                {"id": id_, "structureSize": structure_sizes},
-                cmdid=msg.cmdid,
-            )
+        simulations = await db.get_simulations(self.user_id, model_id)
 
-        if msg.cmd == "contact-map":
-            model = fetch_model(msg.data["model_id"], msg.data["user_id"])
-            cm = contact_map(model)
+        await self.send_message("simulations", {"simulations": simulations}, cmdid=msg.cmdid)
 
-            await self.send_message("contact-map", cm)
+    async def _handle_create_geometry(self, msg: Message) -> None:
+        geometry_config = msg.data
 
-        if msg.cmd == "reactivity-network":
-            model = fetch_model(msg.data["model_id"], msg.data["user_id"])
-            rn = reactivity_network(model)
-            await self.send_message("reactivity-network", rn)
+        id_ = str(uuid4())
+        structure_sizes = create_geometry(id_, geometry_config)
 
-        if msg.cmd == "get_exported_model":
-            model_data = GetExportedModel(**msg.data)
+        await self.send_message(
+            "geometry",
+            {"id": id_, "structureSize": structure_sizes},
+            cmdid=msg.cmdid,
+        )
+
+    async def _handle_contact_map(self, msg: Message) -> None:
+        model = fetch_model(msg.data["model_id"], msg.data["user_id"])
+        cm = contact_map(model)
+
+        await self.send_message("contact-map", cm)
 
-            model = ""
-            error_msg = ""
-            try:
-                model = get_exported_model(model_data.model.dict(exclude_none=True), model_data.format)
-            except Exception as error:
-                L.warning("Model export error")
-                error_msg = error.args[0] if len(error.args) > 0 else "Model export error"
-
-            await self.send_message(
-                "exported_model",
-                {"fileContent": model, "error": error_msg},
-                cmdid=msg.cmdid,
+    async def _handle_reactivity_network(self, msg: Message) -> None:
+        model = fetch_model(msg.data["model_id"], msg.data["user_id"])
+        rn = reactivity_network(model)
+        await self.send_message("reactivity-network", rn)
+
+    async def _handle_get_exported_model(self, msg: Message) -> None:
+        model = ""
+        error_msg = ""
+        try:
+            model_data = GetExportedModel(**msg.data)
+            model_dict = model_data.model.dict(exclude_none=True)
+            model = await exported_model_cache.get(
+                (model_digest(model_dict), model_data.format),
+                lambda: run_in_cpu_pool(get_exported_model, model_dict, model_data.format),
             )
+        except Exception as error:
+            L.warning("Model export error %s: %s", type(error), error.args)
+            error_msg = str(error.args[0]) if len(error.args) > 0 else "Model export error"
+
+        await self.send_message(
+            "exported_model",
+            {"fileContent": model, "error": error_msg},
+            cmdid=msg.cmdid,
+        )
+
+    async def _handle_convert_from_sbml(self, msg: Message) -> None:
+        sbml = ""
+        try:
+            sbml = await run_in_cpu_pool(sbml_to_bngl, msg.data["sbml"])
+        except (ValueError, KeyError, BrokenProcessPool) as e:
+            L.warning("Model import error %s: %s", type(e), e.args)
 
-        if msg.cmd == "convert_from_sbml":
-            sbml = ""
-            try:
-                sbml = sbml_to_bngl(msg.data["sbml"])
-            except (ValueError, KeyError) as e:
-                L.warning(f"Model import error {type(e)}: {e.args}")
-
-            await self.send_message("from_sbml", sbml, cmdid=msg.cmdid)
-
-        if msg.cmd == "revision_from_excel":
-            await self.send_message("revision_from_excel", revision_from_excel(msg.data), cmdid=msg.cmdid)
-
-        if msg.cmd == "query_molecular_repo":
-            query = msg.data
-            result = await db.query_molecular_repo(query)
-            await self.send_message("query_result", {"queryResult": result}, cmdid=msg.cmdid)
-
-        if msg.cmd == "query_branch_names":
-            branch_names = await db.query_branch_names(msg.data)
-            await self.send_message("branch_names", {"branches": branch_names}, cmdid=msg.cmdid)
-
-        if msg.cmd == "get_user_branches":
-            branches = await db.get_user_branches(self.user_id)
-            await self.send_message("user_branches", {"userBranches": branches}, cmdid=msg.cmdid)
-
-        if msg.cmd == "query_revisions":
-            branch_name = msg.data
-            revisions = await db.query_revisions(branch_name)
-            await self.send_message("revisions", {"revisions": revisions}, cmdid=msg.cmdid)
-
-        if msg.cmd == "save_revision":
-            revision_data = msg.data
-            revision_meta = await db.save_revision(revision_data, self.user_id)
-            await self.send_message("save_revision", revision_meta, cmdid=msg.cmdid)
-
-        if msg.cmd == "get_revision":
-            branch = msg.data["branch"]
-            revision = msg.data["revision"]
-            revision_data = await db.get_revision(branch, revision)
-            await self.send_message("revision_data", {"revision": revision_data}, cmdid=msg.cmdid)
-
-        if msg.cmd == "get_branch_latest_rev":
-            branch = msg.data
-            branch_latest_rev = await db.get_branch_latest_rev(branch)
-            await self.send_message("branch_latest_rev", {"rev": branch_latest_rev}, cmdid=msg.cmdid)
-
-        if msg.cmd == "get_spatial_step_trace":
-            sim_id = msg.data["simId"]
-            step_idx = msg.data["stepIdx"]
-            spatial_step_trace = await db.get_spatial_step_trace(sim_id, step_idx)
-            await self.send_message("spatial_step_trace", spatial_step_trace, cmdid=msg.cmdid)
-
-        if msg.cmd == "get_last_spatial_step_trace_idx":
-            sim_id = msg.data["simId"]
-            step_idx = await db.get_last_spatial_step_trace_idx(sim_id)
-            await self.send_message("last_spatial_step_trace_idx", step_idx, cmdid=msg.cmdid)
+        await self.send_message("from_sbml", sbml, cmdid=msg.cmdid)
+
+    async def _handle_revision_from_excel(self, msg: Message) -> None:
+        try:
+            revision = await run_in_cpu_pool(revision_from_excel, msg.data)
+        except BrokenProcessPool as e:
+            L.warning("Model import error %s: %s", type(e), e.args)
+            # Same shape revision_from_excel gives for unreadable sheets
+            revision = {sheet_name: [] for sheet_name in REVISION_STRUCTURE}
+
+        await self.send_message("revision_from_excel", revision, cmdid=msg.cmdid)
+
+    async def _handle_query_molecular_repo(self, msg: Message) -> None:
+        query = msg.data
+        result = await db.query_molecular_repo(query)
+        await self.send_message("query_result", {"queryResult": result}, cmdid=msg.cmdid)
+
+    async def _handle_query_branch_names(self, msg: Message) -> None:
+        branch_names = await db.query_branch_names(msg.data)
+        await self.send_message("branch_names", {"branches": branch_names}, cmdid=msg.cmdid)
+
+    async def _handle_get_user_branches(self, msg: Message) -> None:
+        branches = await db.get_user_branches(self.user_id)
+        await self.send_message("user_branches", {"userBranches": branches}, cmdid=msg.cmdid)
+
+    async def _handle_query_revisions(self, msg: Message) -> None:
+        branch_name = msg.data
+        revisions = await db.query_revisions(branch_name)
+        await self.send_message("revisions", {"revisions": revisions}, cmdid=msg.cmdid)
+
+    async def _handle_save_revision(self, msg: Message) -> None:
+        revision_data = msg.data
+        revision_meta = await db.save_revision(revision_data, self.user_id)
+        await self.send_message("save_revision", revision_meta, cmdid=msg.cmdid)
+
+    async def _handle_get_revision(self, msg: Message) -> None:
+        branch = msg.data["branch"]
+        revision = msg.data["revision"]
+        revision_data = await db.get_revision(branch, revision)
+        await self.send_message("revision_data", {"revision": revision_data}, cmdid=msg.cmdid)
+
+    async def _handle_get_branch_latest_rev(self, msg: Message) -> None:
+        branch = msg.data
+        branch_latest_rev = await db.get_branch_latest_rev(branch)
+        await self.send_message("branch_latest_rev", {"rev": branch_latest_rev}, cmdid=msg.cmdid)
+
+    async def _handle_get_spatial_step_trace(self, msg: Message) -> None:
+        sim_id = msg.data["simId"]
+        step_idx = msg.data["stepIdx"]
+        spatial_step_trace = await db.get_spatial_step_trace(sim_id, step_idx)
+        await self.send_message("spatial_step_trace", spatial_step_trace, cmdid=msg.cmdid)
+
+    async def _handle_get_last_spatial_step_trace_idx(self, msg: Message) -> None:
+        sim_id = msg.data["simId"]
+        step_idx = await db.get_last_spatial_step_trace_idx(sim_id)
+        await self.send_message("last_spatial_step_trace_idx", step_idx, cmdid=msg.cmdid)
+
+    # Built once with the plain functions so dispatch is a single dict lookup
+    HANDLERS: ClassVar[Dict[str, Callable[["WSHandler", Message], Awaitable[None]]]] = {
+        "run_simulation": _handle_run_simulation,
+        "get_log": _handle_get_log,
+        "get_trace": _handle_get_trace,
+        "cancel_simulation": _handle_cancel_simulation,
+        "create_simulation": _handle_create_simulation,
+        "update_simulation": _handle_update_simulation,
+        "delete_simulation": _handle_delete_simulation,
+        "get_simulations": _handle_get_simulations,
+        "create_geometry": _handle_create_geometry,
+        "contact-map": _handle_contact_map,
+        "reactivity-network": _handle_reactivity_network,
+        "get_exported_model": _handle_get_exported_model,
+        "convert_from_sbml": _handle_convert_from_sbml,
+        "revision_from_excel": _handle_revision_from_excel,
+        "query_molecular_repo": _handle_query_molecular_repo,
+        "query_branch_names": _handle_query_branch_names,
+        "get_user_branches": _handle_get_user_branches,
+        "query_revisions": _handle_query_revisions,
+        "save_revision": _handle_save_revision,
+        "get_revision": _handle_get_revision,
+        "get_branch_latest_rev": _handle_get_branch_latest_rev,
+        "get_spatial_step_trace": _handle_get_spatial_step_trace,
+        "get_last_spatial_step_trace_idx": _handle_get_last_spatial_step_trace_idx,
+    }
 
     def on_close(self) -> None:
         self.closed = True
@@ -245,7 +359,11 @@ class WSHandler(WebSocketHandler):
         if self.closed:
             return
 
-        payload = json.dumps({"cmd": cmd, "cmdid": cmdid, "data": data}, cls=ExtendedJSONEncoder)
+        await self.send_raw(encode_message(cmd, data, cmdid=cmdid))
+
+    async def send_raw(self, payload: bytes) -> None:
+        if self.closed:
+            return
 
         try:
             await self.write_message(payload)
@@ -253,6 +371,9 @@ class WSHandler(WebSocketHandler):
             self.on_close()
             L.exception(e)
 
+    async def send_trace_batch(self, encoded_traces: List[bytes]) -> None:
+        await self.send_raw(encode_raw_message("simTraceBatch", b"[" + b",".join(encoded_traces) + b"]"))
+
 
 class SimRunnerWSHandler(WebSocketHandler):
     def __init__(self, *args, **kwargs) -> None:
@@ -269,20 +390,23 @@ class SimRunnerWSHandler(WebSocketHandler):
 
     # pylint: disable=invalid-overridden-method
     async def on_message(self, rawMessage: Union[str, bytes]) -> None:
-        msg = SimWorkerMessage(**json.loads(rawMessage))
+        msg = SIM_WORKER_MESSAGE_DECODER.decode(rawMessage)
         await sim_manager.process_worker_message(self.sim_worker, msg)
 
     def on_close(self) -> None:
         L.info("sim worker connection has been closed")
         self.closed = True
-        coro = sim_manager.remove_worker(self.sim_worker)
-        asyncio.create_task(coro)
+        create_background_task(sim_manager.remove_worker(self.sim_worker))
 
     async def send_message(self, cmd: str, data: Any = None, cmdid: Optional[int] = None) -> None:
         if self.closed:
             return
 
-        payload = json.dumps({"cmd": cmd, "cmdid": cmdid, "data": data}, cls=ExtendedJSONEncoder)
+        await self.send_raw(encode_message(cmd, data, cmdid=cmdid))
+
+    async def send_raw(self, payload: bytes) -> None:
+        if self.closed:
+            return
 
         try:
             await self.write_message(payload)
@@ -304,7 +428,7 @@ class ModelsHandler(RequestHandler):
     async def get(self) -> None:
         user_id = self.get_argument("user_id", "")
         models = await db.db.models.find({"userId": user_id}).to_list(None)
-        self.write(json.dumps(models, cls=ExtendedJSONEncoder))
+        self.write(encode_json(models))
 
     async def options(self) -> None:
         self.set_status(204)
@@ -328,7 +452,7 @@ class GetSimHandler(RequestHandler):
     async def get(self) -> None:
         sim_id = self.get_argument("sim_id")
         sim = await db.db.simulations.find_one({"id": sim_id})
-        self.write(json.dumps(sim, cls=ExtendedJSONEncoder))
+        self.write(encode_json(sim))
 
 
 class CreateSimHandler(RequestHandler):
@@ -341,7 +465,7 @@ class GetSimTracesHandler(RequestHandler):
     async def get(self) -> None:
         sim_id = self.get_argument("sim_id")
         traces = await db.get_sim_trace(sim_id)
-        self.write(json.dumps(traces, cls=ExtendedJSONEncoder))
+        self.write(encode_json(traces))
 
 
 class HealthHandler(RequestHandler):
@@ -351,6 +475,7 @@ class HealthHandler(RequestHandler):
 
 def on_terminate(signum: int, frame: FrameType):  # pylint: disable=unused-argument
     L.debug("received shutdown signal")
+    cpu_pool.shutdown(wait=False)
     tornado.ioloop.IOLoop.current().stop()
 
 
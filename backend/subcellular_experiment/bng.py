@@ -91,14 +91,14 @@ def run_bng(sim_config: dict, progress_cb: Callable[[Any], None]) -> None:
         values_chunk = values[i : i + elements_per_chunk].T
 
         values_by_observable = {
-            observables[i]: [v if not math.isnan(v) else 0 for v in values_chunk[i].tolist()]
+            observables[i]: np.where(np.isnan(values_chunk[i]), 0, values_chunk[i])
             for i in range(len(observables))
         }
 
         progress_cb(
             SimTrace(
                 index=i,
-                times=[float(n) for n in times_chunk.tolist()],
+                times=times_chunk,
                 values_by_observable=values_by_observable,
                 persist=True,
             )
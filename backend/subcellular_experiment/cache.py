@@ -0,0 +1,86 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from cachetools import Cache, LRUCache, TTLCache
+
+from .logger import get_logger
+
+L = get_logger(__name__)
+
+
+class PendingFetch:
+    """Fetch in progress for a cache key."""
+
+    def __init__(self, future: asyncio.Future) -> None:
+        self.future = future
+        # Set when the key is invalidated before the fetch completes
+        self.invalidated = False
+
+
+class QueryCache:
+    """TTL cache for query results, plain LRU when ttl is None.
+
+    With getsizeof, maxsize is the total size of the cached values rather than their count,
+    values bigger than maxsize are not cached.
+
+    Concurrent lookups of the same missing key are coalesced so that only one of them
+    hits the database, the others await the same pending fetch.
+
+    A result fetched while its key got invalidated is returned but not stored, as it might
+    predate the write that triggered the invalidation.
+    """
+
+    def __init__(
+        self, maxsize: int = 1024, ttl: Optional[float] = 30, getsizeof: Optional[Callable[[Any], int]] = None
+    ) -> None:
+        self.cache: Cache = (
+            TTLCache(maxsize=maxsize, ttl=ttl, getsizeof=getsizeof)
+            if ttl is not None
+            else LRUCache(maxsize=maxsize, getsizeof=getsizeof)
+        )
+        # In-flight fetches by key, callers missing the cache while one is pending await it
+        self.pending: Dict[Tuple, PendingFetch] = {}
+
+    async def get(self, key: Tuple, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable query arguments, nothing to cache
+            return await fetch()
+
+        pending = self.pending.get(key)
+        if pending is not None:
+            # shielded so that a client going away doesn't cancel the fetch for the others
+            return await asyncio.shield(pending.future)
+
+        pending = PendingFetch(asyncio.ensure_future(fetch()))
+        self.pending[key] = pending
+        try:
+            value = await asyncio.shield(pending.future)
+        finally:
+            self.pending.pop(key, None)
+
+        # None is what mongo_autoreconnect returns after giving up
+        if value is not None and not pending.invalidated:
+            try:
+                self.cache[key] = value
+            except ValueError:
+                L.debug("%s result is too large to be cached", key[0])
+        return value
+
+    def invalidate(self, *key_prefix: Any) -> None:
+        """Drop all entries which keys start with key_prefix."""
+        prefix_len = len(key_prefix)
+
+        for key, pending in self.pending.items():
+            if key[:prefix_len] == key_prefix:
+                pending.invalidated = True
+
+        stale_keys = [key for key in list(self.cache.keys()) if key[:prefix_len] == key_prefix]
+        for key in stale_keys:
+            self.cache.pop(key, None)
+
+        if stale_keys:
+            L.debug("invalidated %d cached %s results", len(stale_keys), key_prefix[0])
@@ -7,8 +7,10 @@ from pymongo.errors import ConfigurationError, AutoReconnect
 from motor.motor_asyncio import AsyncIOMotorClient
 from sentry_sdk import capture_message
 
+from .cache import QueryCache
 from .model_to_bngl import ENTITY_TYPES
 from .logger import get_logger, log_many
+from .utils import create_background_task
 from .envvars import MONGO_URI, DB_HOST, DB_PASSWORD
 from .types import SimId, Simulation, UpdateSimulation
 
@@ -22,6 +24,10 @@ mol_def_r = re.compile(r"([a-zA-Z][a-zA-Z_0-9]*)\(")
 st_def_r = re.compile("@([a-zA-Z][a-zA-Z_0-9]*)")
 param_def_r = re.compile("([a-zA-Z][a-zA-Z_0-9]*)")
 
+SPATIAL_STEP_TRACE_CACHE_BYTES = 128 * 1024 * 1024
+# List slot plus a boxed int or float
+PY_LIST_ITEM_BYTES = 8 + 24
+
 
 def get_expr_entities(expr, entity_dict):
     tokens = [match_obj.groups()[0] for match_obj in list(param_def_r.finditer(expr))]
@@ -81,6 +87,25 @@ async def mongo_autoreconnect(wrapped, instance, args, kwargs):  # pylint: disab
     log_many("Can't connect to mongodb", L.error, capture_message)
 
 
+def spatial_step_trace_size(trace: dict) -> int:
+    """Approximate memory footprint of a spatial step trace document, dominated by its idxs and molCounts lists."""
+    item_count = sum(
+        len(values) for mols in trace["data"].values() for mol_data in mols.values() for values in mol_data.values()
+    )
+    return item_count * PY_LIST_ITEM_BYTES
+
+
+def cached_query(cache_attr="query_cache"):
+    """Serve repeated reads from a Db cache, keyed on the method name and its arguments."""
+
+    @wrapt.decorator
+    async def wrapper(wrapped, instance, args, kwargs):
+        key = (wrapped.__name__, *args, *sorted(kwargs.items()))
+        return await getattr(instance, cache_attr).get(key, lambda: wrapped(*args, **kwargs))
+
+    return wrapper
+
+
 class Db:
     def __init__(self):
         uri = f"mongodb://admin:{DB_PASSWORD}@{DB_HOST}:27017/" if DB_PASSWORD else f"mongodb://{DB_HOST}:27017/"
@@ -94,9 +119,14 @@ class Db:
             raise ConfigurationError(message="MONGO_URI envar not set")
 
         self.db = self.mongo_client[MONGO_URI]
+        self.query_cache = QueryCache()
+        # Spatial step traces are immutable once written but can weigh megabytes each, bound them by size.
+        self.spatial_step_trace_cache = QueryCache(
+            maxsize=SPATIAL_STEP_TRACE_CACHE_BYTES, ttl=None, getsizeof=spatial_step_trace_size
+        )
 
     def create_indexes(self):
-        asyncio.create_task(self._create_indexes())
+        create_background_task(self._create_indexes())
 
     async def _create_indexes(self):
         await self.db.simulations.create_index(
@@ -132,7 +162,9 @@ class Db:
     @mongo_autoreconnect
     async def create_simulation(self, simulation: Simulation):
         await self.db.simulations.insert_one({**simulation.dict(), "deleted": False})
+        self.query_cache.invalidate("get_simulations", simulation.userId)
 
+    @cached_query()
     @mongo_autoreconnect
     async def get_simulations(self, user_id: str, model_id: str):
         return await self.db.simulations.find({"userId": user_id, "modelId": model_id, "deleted": False}).to_list(None)
@@ -143,6 +175,7 @@ class Db:
             {"id": simulation.id, "userId": simulation.userId, "deleted": False},
             {"$set": simulation.dict(exclude_none=True)},
         )
+        self.query_cache.invalidate("get_simulations", simulation.userId)
 
     @mongo_autoreconnect
     async def create_sim_spatial_step_trace(self, spatial_step_trace: dict) -> None:
@@ -172,6 +205,7 @@ class Db:
     async def delete_sim_log(self, simulation: SimId):
         await self.db.simLogs.delete_many({"simId": simulation.id})
 
+    @cached_query("spatial_step_trace_cache")
     @mongo_autoreconnect
     async def get_spatial_step_trace(self, sim_id, step_idx):
         return await self.db.simSpatialStepTraces.find_one(
@@ -201,15 +235,19 @@ class Db:
             {"id": simulation.id, "userId": simulation.userId},
             {"$set": {"deleted": True}},
         )
+        self.query_cache.invalidate("get_simulations", simulation.userId)
 
     @mongo_autoreconnect
     async def delete_sim_spatial_traces(self, simulation: SimId):
         await self.db.simSpatialStepTraces.delete_many({"simId": simulation.id})
+        self.spatial_step_trace_cache.invalidate("get_spatial_step_trace", simulation.id)
 
+    @cached_query()
     @mongo_autoreconnect
     async def query_branch_names(self, search_str):
         return await self.db.repo.find({"branch": {"$regex": search_str}}).distinct("branch")
 
+    @cached_query()
     @mongo_autoreconnect
     async def query_revisions(self, branch_name):
         return await self.db.repo.find({"branch": branch_name}).distinct("rev")
@@ -333,11 +371,13 @@ class Db:
         all_entities = await self.db.repo.find({"branch": branch, "rev": query_rev}).to_list(None)
         return revision_data_from_entity_list(all_entities)
 
+    @cached_query()
     @mongo_autoreconnect
     async def get_user_branches(self, user_id):
         branches = await self.db.repo.find({"userId": user_id}).distinct("branch")
         return branches
 
+    @cached_query()
     @mongo_autoreconnect
     async def get_branch_latest_rev(self, branch):
         return max(await self.db.repo.find({"branch": branch}).distinct("rev"))
@@ -369,7 +409,7 @@ class Db:
                     "userId": user_id,
                 }
                 db_entry.pop("_id", None)
-                L.debug("saving: {}".format(db_entry))
+                L.debug("saving: %s", db_entry)
                 saved_id = self.db.repo.insert_one(db_entry).inserted_id
                 db_entry["_id"] = saved_id
                 saved_db_entities.append(db_entry)
@@ -472,4 +512,9 @@ class Db:
             db_entry["_id"] = saved_id
             saved_db_entities.append(db_entry)
 
+        self.query_cache.invalidate("query_branch_names")
+        self.query_cache.invalidate("query_revisions", branch)
+        self.query_cache.invalidate("get_branch_latest_rev", branch)
+        self.query_cache.invalidate("get_user_branches", user_id)
+
         return {"branch": branch, "rev": rev}
@@ -25,16 +25,16 @@ def create_geometry(id_: str, geometry_config: dict) -> Dict[str, float]:
 
     geometry_path = os.path.join(GEOMETRY_ROOT_PATH, id_)
     os.makedirs(geometry_path)
-    os.chdir(geometry_path)
+    mesh_path_root = os.path.join(geometry_path, mesh_name_root)
     for tetgen_type, extension in TETGEN_TYPE_EXTENSION.items():
-        filename = f"{mesh_name_root}.{extension}"
+        filename = f"{mesh_path_root}.{extension}"
         with open(filename, "w") as file:
             file.write(geometry_config["mesh"]["volume"]["raw"][tetgen_type])
 
-    mesh = meshio.importTetGen(mesh_name_root, meta["scale"])[0]
+    mesh = meshio.importTetGen(mesh_path_root, meta["scale"])[0]
     meshio.saveMesh(os.path.join(geometry_path, "mesh"), mesh)
 
-    with open("geometry.json", "w") as file:
+    with open(os.path.join(geometry_path, "geometry.json"), "w") as file:
         file.write(json.dumps(meta))
 
     idx_map = {"compartment": "tetIdxs", "membrane": "triIdxs"}
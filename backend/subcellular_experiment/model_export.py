@@ -2,7 +2,6 @@ import tempfile
 import os
 import json
 
-import shutil
 from pysb.importers import bngl
 from pysb.export import export
 
@@ -25,14 +24,10 @@ def get_exported_model(model: dict, model_format: ModelFormat):
 
 
 def pysb_model_from_bngl_str(bngl_str: str):
-    tmp_dir = tempfile.mkdtemp()
-    os.chdir(tmp_dir)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_path = os.path.join(tmp_dir, "model.bngl")
 
-    with open("model.bngl", "w") as model_file:
-        model_file.write(bngl_str)
+        with open(model_path, "w") as model_file:
+            model_file.write(bngl_str)
 
-    pysb_model = bngl.model_from_bngl(os.path.join(os.getcwd(), "model.bngl"))
-
-    shutil.rmtree(tmp_dir)
-
-    return pysb_model
+        return bngl.model_from_bngl(model_path)
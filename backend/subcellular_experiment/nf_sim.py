@@ -155,12 +155,12 @@ class NfSim:
 
             values_chunk = values[i : i + elements_per_chunk].T
 
-            values_by_observable = {observables[i]: values_chunk[i].tolist() for i in range(len(observables))}
+            values_by_observable = {observables[i]: values_chunk[i] for i in range(len(observables))}
 
             self.send_progress(
                 SimTrace(
                     index=i,
-                    times=times_chunk.tolist(),
+                    times=times_chunk,
                     values_by_observable=values_by_observable,
                     persist=True,
                 )
@@ -1,28 +1,31 @@
 from typing import Dict, List, Optional, Union
 
+import numpy as np
 from typing_extensions import Literal
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
 
-from .types import SimStatus as SimStatusLiteral
+from .types import SimStatus as SimStatusLiteral, TraceDtype
 
 
-STIMULUS_TYPE_BY_CODE = {
-    0: "setParam",
-    1: "setConc",
-    2: "clampConc",
-}
+STIMULUS_TYPE_BY_CODE = ("setParam", "setConc", "clampConc")
+
+_STIMULUS_TYPE_LUT = np.array(STIMULUS_TYPE_BY_CODE, dtype=object)
 
 
 def decompress_stimulation(stimulation):
-    stimuli = []
-    for idx in range(stimulation["size"]):
-        t = stimulation["data"][idx * 4]
-        stim_type = STIMULUS_TYPE_BY_CODE[stimulation["data"][idx * 4 + 1]]
-        target = stimulation["targetValues"][stimulation["data"][idx * 4 + 2]]
-        value = stimulation["data"][idx * 4 + 3]
-        stimuli.append({"t": t, "type": stim_type, "target": target, "value": value})
+    """Expand flat [t, typeCode, targetIdx, value, ...] stimulation data into a list of stimuli."""
+    size = stimulation["size"]
+    data = np.asarray(stimulation["data"])[: size * 4].reshape(size, 4)
+
+    times = data[:, 0].tolist()
+    stim_types = _STIMULUS_TYPE_LUT[data[:, 1].astype(np.intp)].tolist()
+    targets = np.asarray(stimulation["targetValues"], dtype=object)[data[:, 2].astype(np.intp)].tolist()
+    values = data[:, 3].tolist()
 
-    return stimuli
+    return [
+        {"t": t, "type": stim_type, "target": target, "value": value}
+        for t, stim_type, target, value in zip(times, stim_types, targets, values)
+    ]
 
 
 class SimSpatialStepTrace(BaseModel):
@@ -48,20 +51,58 @@ class SimProgress(BaseModel):
     progress: float
 
 
+def as_float_array(values) -> np.ndarray:
+    """Float array view of values, keeping the precision of float arrays, float64 otherwise."""
+    if isinstance(values, np.ndarray) and values.dtype.kind == "f":
+        return values
+    return np.asarray(values, dtype=np.float64)
+
+
 class SimTrace(BaseModel):
     """Simulation trace for a given observable.
 
+    Times and values are kept as typed numpy arrays, orjson serializes them straight from
+    their buffers.
+
     Attributes:
-        times: List of time points
-        values: Dict mapping of observables to values
+        times: Array of time points
+        values: Dict mapping of observables to arrays of values
     """
 
     type: Literal["simTrace"] = "simTrace"
     index: int
     persist: bool = False
     stream: bool = True
-    times: List[float]
-    values_by_observable: Dict[str, List[float]]
+    times: np.ndarray
+    values_by_observable: Dict[str, np.ndarray]
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    @validator("times", pre=True)
+    def times_as_array(cls, times):  # pylint: disable=no-self-argument
+        return np.asarray(times, dtype=np.float64)
+
+    @validator("values_by_observable", pre=True)
+    def values_as_arrays(cls, values_by_observable):  # pylint: disable=no-self-argument
+        return {observable: as_float_array(values) for observable, values in values_by_observable.items()}
+
+    def astype(self, dtype: TraceDtype) -> "SimTrace":
+        """Copy of the trace with values cast to dtype, used to shrink streamed traces."""
+        values_by_observable = {
+            observable: values.astype(dtype, copy=False) for observable, values in self.values_by_observable.items()
+        }
+        return self.copy(update={"values_by_observable": values_by_observable})
+
+    def to_document(self) -> dict:
+        """Dict with arrays converted to lists, as required by mongo."""
+        return {
+            **self.dict(),
+            "times": self.times.tolist(),
+            "values_by_observable": {
+                observable: values.tolist() for observable, values in self.values_by_observable.items()
+            },
+        }
 
 
 class SimStatus(BaseModel):
@@ -1,8 +1,11 @@
 # pylint: disable=dangerous-default-value
 import os
+import asyncio
+import logging
 from typing import Optional, List, Dict, Any
 from collections import defaultdict
-import json
+
+import msgspec
 
 from .sim import (
     SimProgress,
@@ -12,7 +15,7 @@ from .sim import (
     SimLog,
     SimStatus,
 )
-from .worker_message import Status, SimWorkerMessage
+from .worker_message import SimWorkerMessage, WORKER_STATUS_DECODER
 from .types import (
     SimConfig,
     SimId,
@@ -20,6 +23,7 @@ from .types import (
     UpdateSimulation,
     SimStatus as SimStatusLiteral,
 )
+from .utils import encode_json, encode_message, encode_raw_message
 from .logger import get_logger
 from .db import Db
 
@@ -53,7 +57,8 @@ class SimManager:
         self.log_workers_status()
 
     def log_workers_status(self) -> None:
-        L.debug(f"workers: {len(self.workers)}, free: {len(self.free_workers)}")
+        if L.isEnabledFor(logging.DEBUG):
+            L.debug("workers: %d, free: %d", len(self.workers), len(self.free_workers))
 
     @property
     def free_workers(self) -> List[SimWorker]:
@@ -61,11 +66,11 @@ class SimManager:
 
     def add_client(self, user_id: str, ws: WebSocketHandler) -> None:
         self.clients[user_id].append(ws)
-        L.debug(f"connection for client {user_id} has been added")
+        L.debug("connection for client %s has been added", user_id)
 
     def remove_client(self, user_id: str, ws: WebSocketHandler) -> None:
         self.clients[user_id].remove(ws)
-        L.debug("connection for client {user_id} has been removed")
+        L.debug("connection for client %s has been removed", user_id)
 
     def prune_workers(self, worker: SimWorker, sim_config: SimConfig) -> None:
         """
@@ -82,35 +87,37 @@ class SimManager:
         self.log_workers_status()
 
     async def process_worker_message(self, worker: SimWorker, msg: SimWorkerMessage) -> None:
-        if msg.message == "worker_connect":
-            if msg.data:
-                L.info("worker_reconnected")
-                sim_config = SimConfig(**msg.data)
-                self.prune_workers(worker, sim_config)
-            return
-
         if msg.message == "status":
-            status = Status(**msg.dict())
+            status = WORKER_STATUS_DECODER.decode(msg.data)
 
-            if status.data == "ready":
+            if status == "ready":
                 worker.sim_conf = None
-            L.debug(f"sim worker reported as {status.data}")
+            L.debug("sim worker reported as %s", status)
             self.log_workers_status()
             await self.run_available()
             return
 
+        data = msgspec.json.decode(msg.data)
+
+        if msg.message == "worker_connect":
+            if data:
+                L.info("worker_reconnected")
+                sim_config = SimConfig(**data)
+                self.prune_workers(worker, sim_config)
+            return
+
         if worker.sim_conf is None:
             L.warning("Worker doesn't have a sim config")
             return
 
         if msg.message == "simProgress":
-            sim_progress = SimProgress(**msg.data)
+            sim_progress = SimProgress(**data)
             await self.process_sim_progress(worker.sim_conf, sim_progress.progress)
         elif msg.message == "simTrace":
-            sim_trace = SimTrace(**msg.data)
-            await self.process_sim_trace(worker.sim_conf, sim_trace)
+            sim_trace = SimTrace(**data)
+            await self.process_sim_trace(worker.sim_conf, sim_trace, msg.data)
         elif msg.message == "simStatus":
-            sim_status = SimStatus(**msg.data)
+            sim_status = SimStatus(**data)
 
             await self.process_sim_status(
                 worker.sim_conf.userId,
@@ -120,7 +127,7 @@ class SimManager:
             )
 
         elif msg.message == "simLog":
-            sim_log = SimLog(**msg.data)
+            sim_log = SimLog(**data)
 
             log = {
                 "log": sim_log.log,
@@ -131,18 +138,18 @@ class SimManager:
             await self.db.create_sim_log(log)
 
         elif msg.message == "simLogMessage":
-            sim_log_msg = SimLogMessage(**msg.data)
+            sim_log_msg = SimLogMessage(**data)
             await self.send_message(
                 worker.sim_conf.userId,
                 "simLogMessage",
                 {**sim_log_msg.dict(), "simId": worker.sim_conf.id},
             )
         elif msg.message == "simSpatialStepTrace":
-            trace = SimSpatialStepTrace(**msg.data)
+            trace = SimSpatialStepTrace(**data)
 
-            await self.process_sim_spatial_step_trace(worker.sim_conf, trace)
+            await self.process_sim_spatial_step_trace(worker.sim_conf, trace, msg.data)
         elif msg.message == "tmp_sim_log":
-            sim_log = SimLog(**msg.data)
+            sim_log = SimLog(**data)
 
             tmp_sim_log = {
                 "log": sim_log.log,
@@ -230,7 +237,7 @@ class SimManager:
         await self.send_message(user_id, "simProgress", {**context, "simId": sim_id, "progress": progress})
 
     async def process_sim_spatial_step_trace(
-        self, sim_conf: SimConfig, spatial_step_trace: SimSpatialStepTrace
+        self, sim_conf: SimConfig, spatial_step_trace: SimSpatialStepTrace, raw_trace: msgspec.Raw
     ) -> None:
         user_id = sim_conf.userId
 
@@ -244,17 +251,14 @@ class SimManager:
             file.truncate()
 
             lead_char = ", " if trace["stepIdx"] > 0 else ""
-            trace_str = json.dumps({**trace, "simId": sim_conf.id})
+            trace_str = encode_json({**trace, "simId": sim_conf.id}).decode()
 
             file.write(f"{lead_char}{trace_str}]")
 
-        await self.send_message(
-            user_id,
-            "simSpatialStepTrace",
-            {**trace, "simId": sim_conf.id},
-        )
+        # The worker payload already carries simId, forward it as is
+        await self.send_raw(user_id, encode_raw_message("simSpatialStepTrace", raw_trace))
 
-    async def process_sim_trace(self, sim_conf: SimConfig, sim_trace: SimTrace) -> None:
+    async def process_sim_trace(self, sim_conf: SimConfig, sim_trace: SimTrace, raw_trace: msgspec.Raw) -> None:
         user_id = sim_conf.userId
         sim_id = sim_conf.id
 
@@ -267,24 +271,26 @@ class SimManager:
                 file.truncate()
 
                 lead_char = ", " if trace["index"] > 0 else ""
-                trace_str = json.dumps({**trace, "simId": sim_conf.id})
+                trace_str = encode_json({**trace, "simId": sim_conf.id}).decode()
 
                 file.write(f"{lead_char}{trace_str}]")
 
         if sim_trace.persist:
             await self.db.create_sim_trace(
                 {
-                    **trace,
+                    **sim_trace.to_document(),
                     "simId": sim_id,
                     "userId": user_id,
                 }
             )
 
-        status_message = {"simId": sim_id, "userId": user_id, "status": "finished"}
-
-        status_message.update(sim_trace.dict())
-        if sim_trace.stream:
-            await self.send_message(user_id, "simTrace", status_message)
+        if sim_trace.stream and sim_conf.traceDtype == "float64":
+            # The worker payload already carries simId and userId, forward it as is
+            await self.send_raw(user_id, encode_raw_message("simTrace", raw_trace))
+        elif sim_trace.stream:
+            # Only the streamed copy is downcast, persisted traces keep full precision
+            streamed_trace = sim_trace.astype(sim_conf.traceDtype)
+            await self.send_message(user_id, "simTrace", {**streamed_trace.dict(), "simId": sim_id, "userId": user_id})
 
     async def send_sim_status(self, user_id: str, sim_id: str, status: SimStatusLiteral, context={}) -> None:
         await self.send_message(
@@ -294,15 +300,21 @@ class SimManager:
         )
 
     async def send_message(self, user_id: str, name: str, message: Any, cmdid=None):
-        for connection in self.clients[user_id]:
-            await connection.send_message(name, message, cmdid=cmdid)
+        if not self.clients[user_id]:
+            return
+
+        await self.send_raw(user_id, encode_message(name, message, cmdid=cmdid))
+
+    async def send_raw(self, user_id: str, payload: bytes):
+        connections = self.clients[user_id]
+        await asyncio.gather(*(connection.send_raw(payload) for connection in connections))
 
     async def run_available(self):
         if len(self.sim_conf_queue) == 0:
             L.debug("sim queueu is empty, nothing to run")
             return
 
-        L.debug(f"{len(self.sim_conf_queue)} simulations in the queue")
+        L.debug("%d simulations in the queue", len(self.sim_conf_queue))
 
         if len(self.free_workers) == 0:
             L.debug("all workers are busy")
@@ -1,6 +1,5 @@
 import os
 import sys
-import json
 import tempfile
 import shutil
 import threading
@@ -13,6 +12,7 @@ from typing import Optional, Any, Dict, List, Union
 from types import FrameType
 import itertools
 
+import orjson
 import sentry_sdk
 from sentry_sdk import capture_message
 from tornado.websocket import (
@@ -23,7 +23,7 @@ from tornado.websocket import (
 
 from .worker_message import WorkerStatus
 from .sim import SimStatus, SimLogMessage, SimData
-from .utils import ExtendedJSONEncoder
+from .utils import encode_json
 from .nf_sim import NfSim
 from .steps_sim import StepsSim
 from .bng import run_bng
@@ -92,7 +92,7 @@ class SimWorker:
         sys.exit(0)
 
     def on_message(self, raw_message: Union[bytes, str]) -> None:
-        message = json.loads(raw_message)
+        message = orjson.loads(raw_message)
 
         if any(key not in message for key in ["data", "cmd", "cmdid"]):
             raise ValueError("Invalid message")
@@ -100,7 +100,7 @@ class SimWorker:
         sim_config = message["data"]
         msg = message["cmd"]
         cmdid = message["cmdid"]
-        L.debug(f"got {msg} from the backend")
+        L.debug("got %s from the backend", msg)
 
         if msg == "run_sim":
             self.on_run_sim_msg(sim_config)
@@ -167,10 +167,7 @@ class SimWorker:
         if self.closed or self.socket is None:
             return
 
-        payload = json.dumps(
-            {"message": message, "data": data, "cmdid": cmdid},
-            cls=ExtendedJSONEncoder,
-        )
+        payload = encode_json({"message": message, "data": data, "cmdid": cmdid})
 
         try:
             await self.socket.write_message(payload)
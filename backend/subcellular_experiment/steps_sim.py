@@ -720,7 +720,7 @@ class StepsSim:
 
         # pylint: disable=unsubscriptable-object
         values_by_observable = {
-            trace_observable_names[i]: values[i].tolist() for i in range(len(trace_observable_names))
+            trace_observable_names[i]: values[i] for i in range(len(trace_observable_names))
         }
 
         self.send_progress(
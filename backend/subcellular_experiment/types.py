@@ -1,5 +1,6 @@
 from typing import Optional, Any, List, Union
 
+import msgspec
 from typing_extensions import Literal
 from tornado import websocket
 from pydantic import BaseModel
@@ -8,6 +9,7 @@ from pydantic import BaseModel
 SimStatus = Literal["created", "queued", "init", "started", "error", "finished", "cancelled"]
 ModelFormat = Literal["bngl", "ebngl", "pysb_flat", "sbml"]
 SimSolver = Literal["tetexact", "tetopsplit", "nfsim", "ode", "ssa"]
+TraceDtype = Literal["float64", "float32"]
 
 
 class SimConfig(BaseModel):
@@ -22,15 +24,20 @@ class SimConfig(BaseModel):
     id: str
     annotation: str
     model_str = ""
+    # Precision of the traces streamed to clients while the sim runs, stored traces are always float64
+    traceDtype: TraceDtype = "float64"
 
 
-class Message(BaseModel):
+class Message(msgspec.Struct):
     cmd: str
-    cmdid: Optional[int]
-    data: Any
+    cmdid: Optional[int] = None
+    data: Any = None
 
 
-class SimId(BaseModel):
+MESSAGE_DECODER = msgspec.json.Decoder(Message)
+
+
+class SimId(msgspec.Struct):
     id: str
     userId: str
 
@@ -154,3 +161,6 @@ class GetExportedModel(BaseModel):
 class WebSocketHandler(websocket.WebSocketHandler):
     async def send_message(self, cmd: str, data: Any = None, cmdid: Optional[int] = None) -> None:
         raise NotImplementedError
+
+    async def send_raw(self, payload: bytes) -> None:
+        raise NotImplementedError
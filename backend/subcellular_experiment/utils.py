@@ -1,22 +1,68 @@
-import json
+import asyncio
 import tempfile
 import os
 import shutil
+from typing import Any, Coroutine, Optional, Set, Union
 from contextlib import contextmanager
 
+import msgspec
 import numpy as np
+import orjson
 from bson.objectid import ObjectId
 
+from .logger import get_logger
 
-class ExtendedJSONEncoder(json.JSONEncoder):
-    """JSON encode numpy instances."""
+L = get_logger(__name__)
 
-    def default(self, o):
-        if isinstance(o, np.ndarray):
-            return o.tolist()
-        if isinstance(o, ObjectId):
-            return str(o)
-        return json.JSONEncoder.default(self, o)
+
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+# The event loop only keeps weak references to tasks, fire-and-forget tasks are kept alive here
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def orjson_default(obj):
+    """Convert objects orjson can't serialize natively.
+
+    Numeric numpy arrays are serialized by orjson straight from their buffer when they are
+    C contiguous, only other arrays end up here.
+    """
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.kind in "biuf" and not obj.flags.c_contiguous:
+            return np.ascontiguousarray(obj)
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def encode_json(obj: Any) -> bytes:
+    return orjson.dumps(obj, default=orjson_default, option=ORJSON_OPTIONS)
+
+
+def encode_message(cmd: str, data: Any = None, cmdid: Optional[int] = None) -> bytes:
+    return encode_json({"cmd": cmd, "cmdid": cmdid, "data": data})
+
+
+def encode_raw_message(cmd: str, raw_data: Union[bytes, msgspec.Raw], cmdid: Optional[int] = None) -> bytes:
+    """Same as encode_message for data which is already JSON encoded."""
+    return b"".join((b'{"cmd":', orjson.dumps(cmd), b',"cmdid":', orjson.dumps(cmdid), b',"data":', raw_data, b"}"))
+
+
+def create_background_task(coro: Coroutine) -> asyncio.Task:
+    """Schedule a coroutine which result is not awaited, keeping the task referenced until it is done."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_on_background_task_done)
+    return task
+
+
+def _on_background_task_done(task: asyncio.Task) -> None:
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        L.error("background task failed", exc_info=task.exception())
 
 
 @contextmanager
@@ -2,6 +2,7 @@
 import os
 import re
 import subprocess
+import tempfile
 import json
 import networkx as nx
 from networkx.readwrite import json_graph
@@ -12,39 +13,41 @@ import pygraphviz
 
 from .gmltojson import gmltojson
 from .model_to_bngl import model_to_bngl
-from .utils import tempdir
 from .settings import BNG_PATH
 
 
-@tempdir()
 def contact_map(model: dict):
     bngl = f"""{model_to_bngl(model)}
     visualize({{type=>"contactmap"}})"""
 
     fname = f'{model["id"]}_viz.bngl'
 
-    with open(fname, "w") as file:
-        file.write(bngl)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with open(os.path.join(tmp_dir, fname), "w") as file:
+            file.write(bngl)
 
-    subprocess.run(
-        [BNG_PATH, fname],
-        check=False,
-        capture_output=True,
-    )
+        subprocess.run(
+            [BNG_PATH, fname],
+            check=False,
+            capture_output=True,
+            cwd=tmp_dir,
+        )
 
-    with open(f"{model['id']}_viz_contactmap.gml", "r") as gmlsrc:
-        return gmltojson(gmlsrc.read())
+        with open(os.path.join(tmp_dir, f"{model['id']}_viz_contactmap.gml"), "r") as gmlsrc:
+            return gmltojson(gmlsrc.read())
 
 
-@tempdir()
 def reactivity_network(model: dict):
     bngl_str = model_to_bngl(model)
 
-    with open(f"{model['id']}.bngl", "w") as model_file:
-        model_file.write(bngl_str)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_path = os.path.join(tmp_dir, f"{model['id']}.bngl")
+
+        with open(model_path, "w") as model_file:
+            model_file.write(bngl_str)
 
-    pysb_model = bngl.model_from_bngl(f"{model['id']}.bngl")
-    pysb.bng.generate_equations(pysb_model)
+        pysb_model = bngl.model_from_bngl(model_path)
+        pysb.bng.generate_equations(pysb_model)
 
     graph: dict = {"nodes": [], "edges": []}
 
@@ -1,6 +1,6 @@
-from typing import Any, Optional
+from typing import Optional
 
-from pydantic import BaseModel
+import msgspec
 from typing_extensions import Literal
 
 WorkerStatus = Literal["ready", "busy"]
@@ -18,12 +18,16 @@ WorkerMessage = Literal[
 ]
 
 
-class SimWorkerMessage(BaseModel):
+class SimWorkerMessage(msgspec.Struct):
+    """Worker message envelope, data is kept JSON encoded until it is needed.
+
+    This lets trace payloads be forwarded to clients without a decode/encode round trip.
+    """
+
     message: WorkerMessage
-    data: Any
-    cmdid: Optional[int]
+    data: msgspec.Raw = msgspec.Raw(b"null")
+    cmdid: Optional[int] = None
 
 
-class Status(SimWorkerMessage):
-    message: Literal["status"]
-    data: WorkerStatus
+SIM_WORKER_MESSAGE_DECODER = msgspec.json.Decoder(SimWorkerMessage)
+WORKER_STATUS_DECODER = msgspec.json.Decoder(WorkerStatus)
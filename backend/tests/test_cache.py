@@ -0,0 +1,94 @@
+import asyncio
+
+from subcellular_experiment.cache import QueryCache
+
+
+def test_concurrent_misses_share_one_fetch():
+    cache = QueryCache()
+    fetch_count = 0
+
+    async def fetch():
+        nonlocal fetch_count
+        fetch_count += 1
+        await asyncio.sleep(0)
+        return "value"
+
+    async def run():
+        return await asyncio.gather(*[cache.get(("query", 1), fetch) for _ in range(3)])
+
+    assert asyncio.run(run()) == ["value"] * 3
+    assert fetch_count == 1
+    assert cache.cache[("query", 1)] == "value"
+    assert not cache.pending
+
+
+def test_caller_arriving_while_waiters_resume():
+    cache = QueryCache()
+    key = ("get_spatial_step_trace", "sim", 3)
+    fetch_count = 0
+
+    async def run():
+        release = asyncio.Event()
+
+        async def fetch():
+            nonlocal fetch_count
+            fetch_count += 1
+            await release.wait()
+            await asyncio.sleep(0)
+            # not written yet, nothing to cache
+            return None
+
+        async def late_get():
+            # resumes once the first caller is done, while the waiter is still to resume
+            await first
+            cache.invalidate("get_spatial_step_trace", "sim")
+            return await cache.get(key, fetch)
+
+        first = asyncio.ensure_future(cache.get(key, fetch))
+        waiter = asyncio.ensure_future(cache.get(key, fetch))
+        late = asyncio.ensure_future(late_get())
+        await asyncio.sleep(0)
+        release.set()
+        return await asyncio.gather(first, waiter, late, return_exceptions=True)
+
+    assert asyncio.run(run()) == [None, None, None]
+    assert fetch_count <= 2
+    assert not cache.pending
+
+
+def test_result_fetched_across_invalidation_is_not_stored():
+    cache = QueryCache()
+    key = ("get_simulations", "user")
+
+    async def run():
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def fetch():
+            started.set()
+            await release.wait()
+            return ["stale"]
+
+        get = asyncio.ensure_future(cache.get(key, fetch))
+        await started.wait()
+        cache.invalidate("get_simulations")
+        release.set()
+        return await get
+
+    assert asyncio.run(run()) == ["stale"]
+    assert key not in cache.cache
+
+
+def test_fetch_error_is_raised_to_all_callers():
+    cache = QueryCache()
+
+    async def fetch():
+        await asyncio.sleep(0)
+        raise ValueError("db error")
+
+    async def run():
+        return await asyncio.gather(*[cache.get(("query",), fetch) for _ in range(2)], return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert not cache.pending
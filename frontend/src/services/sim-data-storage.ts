@@ -32,7 +32,7 @@ bus.$on('ws:simLogMessage', (logMsg: {}) => {
   watcherCb(cache[logMsg.simId].log)
 })
 
-bus.$on('ws:simTrace', (trace: SimTrace) => {
+function onSimTrace(trace: SimTrace) {
   if (!get(cache, `${trace.simId}.trace`)) {
     set(cache, `${trace.simId}.trace`, trace)
   } else {
@@ -49,7 +49,11 @@ bus.$on('ws:simTrace', (trace: SimTrace) => {
 
   const watcherCb = get(watcher, `${trace.simId}.trace`, noop)
   watcherCb(trace)
-})
+}
+
+bus.$on('ws:simTrace', onSimTrace)
+
+bus.$on('ws:simTraceBatch', (traces: SimTrace[]) => traces.forEach(onSimTrace))
 
 bus.$on('ws:simStepTrace', (stepTrace: {}) => {
   if (!get(cache, `${stepTrace.simId}.trace`)) {